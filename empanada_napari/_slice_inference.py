@@ -32,11 +32,22 @@ def test_widget():
         axis,
         plane,
         y,
-        x
+        x,
+        level_scale=1,
+        size=None
     ):
+        # load lazy slices off of the GUI thread, only
+        # the chunks overlapping the slice are read
+        if type(image) == da.core.Array:
+            image = image.compute(scheduler='threads')
+
         # create the inference engine
         start = time()
-        seg = engine.infer(image) 
+        if image.ndim == 3:
+            # stack of adjacent slices
+            seg = engine.infer_batch(image, level_scale, size)
+        else:
+            seg = engine.infer(image, level_scale, size) 
         print(f'Inference time:', time() - start)
         return seg, axis, plane, y, x
 
@@ -96,6 +107,7 @@ def test_widget():
         semantic_only=dict(widget_type='CheckBox', text='Semantic only', value=False, tooltip='Only run semantic segmentation for all classes.'),
         maximum_objects_per_class=dict(widget_type='LineEdit', value='100000', label='Max objects per class'),
         tile_size=dict(widget_type='SpinBox', value=0, min=0, max=4096, step=256, label='Tile size', tooltip='Tile size for inference, whole image will be segmented if 0'),
+        n_slices=dict(widget_type='SpinBox', value=1, min=1, max=16, step=1, label='Number of slices', tooltip='Number of slices around the current one to segment together in a batch, only for 3D images'),
         batch_mode=dict(widget_type='CheckBox', text='Batch mode', value=False, tooltip='If checked, each image in a stack is segmented independently.'),
         viewport=dict(widget_type='CheckBox', text='Confine to viewport', value=False, tooltip='If checked, inference will be restricted to the current viewport.'),
         output_to_layer=dict(widget_type='CheckBox', text='Output to layer', value=False, tooltip='If checked, the segmentation is output to the selected output layer.'),
@@ -123,6 +135,7 @@ def test_widget():
         semantic_only,
         maximum_objects_per_class,
         tile_size,
+        n_slices,
         batch_mode,
         use_gpu,
         use_quantized,
@@ -217,14 +230,58 @@ def test_widget():
 
             return yslice, xslice
 
+        def _inference_level(image_layer, yaxis, xaxis):
+            # pick the coarsest pyramid level that is no coarser
+            # than the downsampling applied before inference anyway
+            base_shape = np.array(image_layer.data[0].shape)
+
+            # slice stacks are only used for 3D images
+            stacked = len(base_shape) == 3 and n_slices > 1
+            if viewport or output_to_layer or tile_size > 0 or stacked:
+                return 0, 1
+
+            sliced_axes = [i for i in range(len(base_shape)) if i not in (yaxis, xaxis)]
+            level, level_scale = 0, 1
+            for i in range(1, len(image_layer.data)):
+                factors = np.round(base_shape / np.array(image_layer.data[i].shape)).astype(int)
+                # a downsampled sliced axis would average several planes
+                if any(factors[a] != 1 for a in sliced_axes):
+                    break
+
+                yf, xf = factors[yaxis], factors[xaxis]
+                # engine resizing only works with equal power of 2 factors
+                if yf != xf or not math.log(yf, 2).is_integer() or downsampling % yf != 0:
+                    break
+
+                level, level_scale = i, int(yf)
+
+            return level, level_scale
+
         def _get_current_slice(image_layer):
             cursor_pos = viewer.cursor.position
 
-            # handle multiscale by taking highest resolution level
             image = image_layer.data
+            ndim = image[0].ndim if image_layer.multiscale else image.ndim
+            if ndim == 4:
+                in_plane = (2, 3)
+            elif ndim == 3:
+                in_plane = tuple(i for i in range(3) if i != viewer.dims.order[0])
+            else:
+                in_plane = (0, 1)
+
+            # handle multiscale by taking the coarsest level that
+            # still has enough resolution for inference, planes
+            # are the same as in the highest resolution level
+            level_scale = 1
+            size = None
             if image_layer.multiscale:
-                print('Using highest resolution level from multiscale!')
-                image = image[0]
+                level, level_scale = _inference_level(image_layer, *in_plane)
+                print(f'Using resolution level {level} from multiscale!')
+                if level_scale > 1:
+                    # segmentation is rendered at the full resolution size
+                    size = tuple(image[0].shape[a] for a in in_plane)
+
+                image = image[level]
 
             y, x = 0, 0
             if image.ndim == 4:
@@ -250,7 +307,13 @@ def test_widget():
                 plane = int(image_layer.world_to_data(cursor_pos)[axis])
 
                 slices = [slice(None), slice(None), slice(None)]
-                slices[axis] = plane
+                if n_slices > 1:
+                    # adjacent slices centered on the current one,
+                    # plane becomes the first slice in the stack
+                    plane = max(plane - n_slices // 2, 0)
+                    slices[axis] = slice(plane, min(plane + n_slices, image.shape[axis]))
+                else:
+                    slices[axis] = plane
                 if viewport:
                     yaxis, xaxis = [i for i in range(3) if i != axis]
                     yslice, xslice = _viewer_slices(image_layer, axis)
@@ -271,7 +334,12 @@ def test_widget():
                     y = yslice.start
                     x = xslice.start
 
-            return image[tuple(slices)], axis, plane, y, x
+            image = image[tuple(slices)]
+            if image.ndim == 3:
+                # stack of slices along the first dimension
+                image = np.moveaxis(image, axis, 0)
+
+            return image, axis, plane, y, x, level_scale, size
 
         def _show_test_result(*args):
             seg, axis, plane, y, x = args[0]
@@ -283,7 +351,10 @@ def test_widget():
                     translate[axis[0]] = plane[0]
                     translate[axis[1]] = plane[1]
                 else:
-                    seg = np.expand_dims(seg, axis=axis)
+                    if seg.ndim == 3:
+                        seg = np.moveaxis(seg, 0, axis)
+                    else:
+                        seg = np.expand_dims(seg, axis=axis)
 
                     # oddly translate has to be a list and
                     # not an array or things break. WHY????
@@ -297,8 +368,11 @@ def test_widget():
             else:
                 translate = [y, x]
 
-            viewer.add_labels(seg, name=f'empanada_seg_2d', visible=True, translate=tuple(translate))
-            viewer.layers[-1].scale = image_layer.scale
+            # set scale on creation so the layer is only sliced once
+            viewer.add_labels(
+                seg, name=f'empanada_seg_2d', visible=True,
+                translate=tuple(translate), scale=image_layer.scale
+            )
 
         def _store_test_result(*args):
             seg, axis, plane, _, _ = args[0]
@@ -313,7 +387,12 @@ def test_widget():
                 else:
                     # 3D case
                     slices = [slice(None), slice(None), slice(None)]
-                    slices[axis] = plane
+                    if seg.ndim == 3:
+                        slices[axis] = slice(plane, plane + len(seg))
+                        seg = np.moveaxis(seg, 0, axis)
+                    else:
+                        slices[axis] = plane
+
                     output_layer.data[tuple(slices)] = seg
             else:
                 # 2D case
@@ -328,12 +407,9 @@ def test_widget():
 
         # load data for currently viewer slice of chosen image layer
         if not batch_mode:
-            image2d, axis, plane, y, x = _get_current_slice(image_layer)
+            image2d, axis, plane, y, x, level_scale, size = _get_current_slice(image_layer)
             print(f'Image of size {image2d.shape} sliced at plane {plane} from axis {axis}')
-            if type(image2d) == da.core.Array:
-                image2d = image2d.compute()
-
-            test_worker = run_model(widget.engine, image2d, axis, plane, y, x)
+            test_worker = run_model(widget.engine, image2d, axis, plane, y, x, level_scale, size)
             if output_to_layer:
                 test_worker.returned.connect(_store_test_result)
             else:
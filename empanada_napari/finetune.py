@@ -1,4 +1,6 @@
+import io
 import os
+import math
 import time
 import yaml
 import platform
@@ -8,7 +10,8 @@ import torch.optim.lr_scheduler as lr_scheduler
 import torch.backends.cudnn as cudnn
 import torch.multiprocessing as mp
 from torch.utils.data import DataLoader
-from torch.cuda.amp import autocast, GradScaler
+from concurrent.futures import ThreadPoolExecutor
+from torch.amp import autocast
 
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
@@ -24,32 +27,16 @@ from empanada_napari.utils import load_model_to_device
 MODEL_DIR = os.path.join(os.path.expanduser('~'), '.empanada')
 torch.hub.set_dir(MODEL_DIR)
 
-schedules = sorted(name for name in lr_scheduler.__dict__
-    if callable(lr_scheduler.__dict__[name]) and not name.startswith('__')
-    and name[0].isupper()
-)
-
-optimizers = sorted(name for name in optim.__dict__
-    if callable(optim.__dict__[name]) and not name.startswith('__')
-    and name[0].isupper()
-)
-
-augmentations = sorted(name for name in A.__dict__
-    if callable(A.__dict__[name]) and not name.startswith('__')
-    and name[0].isupper()
-)
-
-datasets = sorted(name for name in data.__dict__
-    if callable(data.__dict__[name])
-)
-
-engine_names = sorted(name for name in engines.__dict__
-    if callable(engines.__dict__[name])
-)
-
-loss_names = sorted(name for name in losses.__dict__
-    if callable(losses.__dict__[name])
-)
+def callable_names(module, classes_only=False):
+    """
+    Returns the set of names of callables in a module.
+    Computed on demand instead of at import time.
+    """
+    return {
+        name for name, obj in module.__dict__.items()
+        if callable(obj) and not name.startswith('__')
+        and (not classes_only or name[0].isupper())
+    }
 
 def main(config):
     # create model directory if None
@@ -57,12 +44,18 @@ def main(config):
         os.mkdir(config['TRAIN']['model_dir'])
 
     # validate parameters
-    assert config['TRAIN']['lr_schedule'] in schedules
-    assert config['TRAIN']['optimizer'] in optimizers
-    assert config['FINETUNE']['criterion'] in loss_names
-    assert config['FINETUNE']['engine'] in engine_names
-
-    main_worker(config)
+    assert config['TRAIN']['lr_schedule'] in callable_names(lr_scheduler, classes_only=True)
+    assert config['TRAIN']['optimizer'] in callable_names(optim, classes_only=True)
+    assert config['FINETUNE']['criterion'] in callable_names(losses)
+    assert config['FINETUNE']['engine'] in callable_names(engines)
+
+    # main_worker enables TF32, the flag is process-global and
+    # finetuning runs inside napari, so restore it for inference
+    allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    try:
+        main_worker(config)
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32
 
 def main_worker(config):
     config['device'] = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -79,44 +72,49 @@ def main_worker(config):
             pass
 
     # setup the model and pick dataset class
-    model = load_model_to_device(config['MODEL']['model'], config['device'])
-    norms = config['MODEL']['norms']
+    # load on cpu, the model is moved to the device once below
+    model = load_model_to_device(config['MODEL']['model'], torch.device('cpu'))
     dataset_class_name = config['FINETUNE']['dataset_class']
     data_cls = data.__dict__[dataset_class_name]
 
     finetune_layer = config['TRAIN']['finetune_layer']
-    # start by freezing all encoder parameters
-    for pname, param in model.named_parameters():
-        if 'encoder' in pname:
-            param.requires_grad = False
-
-    # freeze encoder layers
-    if finetune_layer == 'none':
-        # leave all encoder layers frozen
-        pass
-    elif finetune_layer == 'all':
-        # unfreeze all encoder parameters
-        for pname, param in model.named_parameters():
-            if 'encoder' in pname:
-                param.requires_grad = True
-    else:
-        valid_layers = ['stage1', 'stage2', 'stage3', 'stage4']
-        assert finetune_layer in valid_layers
+    valid_layers = ['stage1', 'stage2', 'stage3', 'stage4']
+    assert finetune_layer in ['none', 'all'] + valid_layers, \
+    f'Invalid finetune_layer {finetune_layer}!'
+
+    encoder = getattr(model, 'encoder', None)
+    if encoder is not None:
         # unfreeze all layers from finetune_layer onward
-        for layer_name in valid_layers[valid_layers.index(finetune_layer):]:
-            # freeze all encoder parameters
-            for pname, param in model.named_parameters():
-                if f'encoder.{layer_name}' in pname:
-                    param.requires_grad = True
+        unfrozen_stages = []
+        if finetune_layer in valid_layers:
+            for layer_name in valid_layers[valid_layers.index(finetune_layer):]:
+                unfrozen_stages.append(get_encoder_stage(encoder, layer_name))
+
+        # start by freezing all encoder parameters,
+        # unless they should all be finetuned
+        for param in encoder.parameters():
+            param.requires_grad = finetune_layer == 'all'
+
+        for stage in unfrozen_stages:
+            for param in stage.parameters():
+                param.requires_grad = True
 
     num_trainable = sum(p[1].numel() for p in model.named_parameters() if p[1].requires_grad)
     print(f'Model with {num_trainable} trainable parameters.')
 
-    model = model.to(config['device'])
+    # NHWC layout lets cudnn pick tensor core kernels
+    model = model.to(config['device'], memory_format=torch.channels_last)
+
+    if torch.cuda.is_available():
+        cudnn.benchmark = True
 
-    cudnn.benchmark = True
+        # let fp32 matmuls outside of autocast use tensor cores,
+        # cudnn already allows TF32 for convs by default.
+        # reset by main() after finetuning finishes
+        torch.backends.cuda.matmul.allow_tf32 = True
 
     # set the training image augmentations
+    augmentations = callable_names(A, classes_only=True)
     config['aug_string'] = []
     dataset_augs = []
     for aug_params in config['TRAIN']['augmentations']:
@@ -131,9 +129,9 @@ def main_worker(config):
 
     config['aug_string'] = ','.join(config['aug_string'])
 
+    # normalization is applied on the device by DataPrefetcher
     tfs = A.Compose([
         *dataset_augs,
-        A.Normalize(**norms),
         ToTensorV2()
     ])
 
@@ -149,23 +147,29 @@ def main_worker(config):
     if platform.system() == "Darwin":
         num_workers = 0
 
+    # keep workers alive between epochs, these options
+    # are only valid with multiprocess data loading
+    worker_params = {}
+    if num_workers > 0:
+        worker_params = {'persistent_workers': True, 'prefetch_factor': 4}
+
     train_loader = DataLoader(
         train_dataset, batch_size=config['TRAIN']['batch_size'], shuffle=True,
-        num_workers=config['TRAIN']['workers'], pin_memory=torch.cuda.is_available(),
-        drop_last=True
+        num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+        drop_last=True, collate_fn=fast_collate, **worker_params
     )
 
     if config['EVAL']['eval_dir'] is not None:
         eval_tfs = A.Compose([
             FactorPad(128), # pad image to be divisible by 128
-            A.Normalize(**norms),
             ToTensorV2()
         ])
         eval_dataset = data_cls(config['EVAL']['eval_dir'], transforms=eval_tfs, **config['FINETUNE']['dataset_params'])
         # evaluation runs on a single gpu
         eval_loader = DataLoader(eval_dataset, batch_size=1, shuffle=False,
                                  pin_memory=torch.cuda.is_available(),
-                                 num_workers=config['TRAIN']['workers'])
+                                 num_workers=config['TRAIN']['workers'],
+                                 collate_fn=fast_collate)
     else:
         eval_loader = None
 
@@ -173,6 +177,13 @@ def main_worker(config):
     criterion_name = config['FINETUNE']['criterion']
     criterion = losses.__dict__[criterion_name](**config['FINETUNE']['criterion_params']).to(config['device'])
 
+    # the model is TorchScript and can't be compiled, but the
+    # loss is eager and its elementwise ops fuse well. training
+    # batches have a fixed shape, so no dynamic shapes are needed
+    train_criterion = criterion
+    if config['TRAIN'].get('compile', False) and hasattr(torch, 'compile'):
+        train_criterion = torch.compile(criterion, dynamic=False)
+
     # set optimizer and lr scheduler
     opt_name = config['TRAIN']['optimizer']
     opt_params = config['TRAIN']['optimizer_params']
@@ -181,14 +192,36 @@ def main_worker(config):
     schedule_name = config['TRAIN']['lr_schedule']
     schedule_params = config['TRAIN']['schedule_params']
 
+    # optimizer steps once every accum_steps batches,
+    # and on the last batch if the epoch has leftovers
+    accum_steps = config['TRAIN'].get('accum_steps', 1)
+    assert isinstance(accum_steps, int) and accum_steps >= 1, \
+    f'accum_steps must be a positive integer, got {accum_steps}!'
+    steps_per_epoch = math.ceil(len(train_loader) / accum_steps)
+
     if 'steps_per_epoch' in schedule_params:
         n_steps = schedule_params['steps_per_epoch']
-        if n_steps != len(train_loader):
-            schedule_params['steps_per_epoch'] = len(train_loader)
-            print(f'Steps per epoch adjusted from {n_steps} to {len(train_loader)}')
+        if n_steps != steps_per_epoch:
+            schedule_params['steps_per_epoch'] = steps_per_epoch
+            print(f'Steps per epoch adjusted from {n_steps} to {steps_per_epoch}')
 
     scheduler = lr_scheduler.__dict__[schedule_name](optimizer, **schedule_params)
-    scaler = GradScaler() if config['TRAIN']['amp'] else None
+
+    # bf16 has the range of fp32 and doesn't need loss scaling,
+    # only Ampere and newer GPUs have bf16 tensor cores
+    if config['device'].type == 'cuda' and torch.cuda.get_device_capability(config['device'])[0] >= 8:
+        config['amp_dtype'] = torch.bfloat16
+    else:
+        config['amp_dtype'] = torch.float16
+
+    if config['TRAIN']['amp'] and config['amp_dtype'] == torch.float16:
+        # torch.amp.GradScaler was added in pytorch 2.3
+        if hasattr(torch.amp, 'GradScaler'):
+            scaler = torch.amp.GradScaler('cuda')
+        else:
+            scaler = torch.cuda.amp.GradScaler()
+    else:
+        scaler = None
 
     config['start_epoch'] = 0
     if 'epochs' in config['TRAIN']['schedule_params']:
@@ -200,10 +233,14 @@ def main_worker(config):
 
     config['TRAIN']['epochs'] = epochs
 
+    # model files are written to disk in the background
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
+
     for epoch in range(config['start_epoch'], epochs):
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer,
+        train(train_loader, model, train_criterion, optimizer,
               scheduler, scaler, epoch, config)
 
         # evaluate on validation set
@@ -215,19 +252,53 @@ def main_worker(config):
         save_now = (epoch + 1) % config['TRAIN']['save_freq'] == 0
         if save_now:
             outpath = os.path.join(config['TRAIN']['model_dir'], config['model_name'])
-            torch.jit.save(model, outpath + '.pth')
+
+            # serialize now so the snapshot isn't changed by the next epoch
+            buffer = io.BytesIO()
+            torch.jit.save(model, buffer)
+
+            # only one write to the same file at a time
+            if save_future is not None:
+                save_future.result()
+
+            save_future = save_executor.submit(write_buffer, buffer, outpath + '.pth')
 
             config['MODEL']['model'] = outpath + '.pth'
             config['MODEL']['model_quantized'] = None
             with open(outpath + '.yaml', mode='w') as f:
                 yaml.dump({'FINETUNE': config['FINETUNE'], **config['MODEL']}, f)
 
+    # model file must exist before it's registered
+    if save_future is not None:
+        save_future.result()
+
+    save_executor.shutdown()
+
+def get_encoder_stage(encoder, layer_name):
+    """
+    Returns the encoder submodule for a stage name like 'stage2'.
+    RegNet encoders name them stageN, ResNet encoders layerN.
+    """
+    stage_idx = layer_name[len('stage'):]
+    for name in [f'stage{stage_idx}', f'layer{stage_idx}']:
+        stage = getattr(encoder, name, None)
+        if stage is not None:
+            return stage
+
+    raise Exception(f'Encoder has no stage{stage_idx} or layer{stage_idx} submodule to finetune!')
+
+def write_buffer(buffer, fpath):
+    with open(fpath, mode='wb') as f:
+        f.write(buffer.getbuffer())
+
 def configure_optimizer(model, opt_name, **opt_params):
     """
     Takes an optimizer and separates parameters into two groups
     that either use weight decay or are exempt.
 
-    Only BatchNorm parameters and biases are excluded.
+    All 1d parameters (biases and BatchNorm, LayerNorm or
+    GroupNorm weights, also inside TorchScript modules) and
+    BatchNorm2d parameters are excluded.
     """
 
     # easy if there's no weight_decay
@@ -236,40 +307,57 @@ def configure_optimizer(model, opt_name, **opt_params):
     elif opt_params['weight_decay'] == 0:
         return optim.__dict__[opt_name](model.parameters(), **opt_params)
 
-    decay = set()
-    no_decay = set()
-    param_dict = {}
+    # separate parameters into two groups in a single traversal,
+    # biases and norm weights are the only 1d parameters
+    decay = []
+    no_decay = []
 
     blacklist = (torch.nn.BatchNorm2d,)
     for mn, m in model.named_modules():
         for pn, p in m.named_parameters(recurse=False):
-            full_name = '%s.%s' % (mn, pn) if mn else pn
+            full_name = f'{mn}.{pn}' if mn else pn
 
-            if full_name.endswith('bias'):
-                no_decay.add(full_name)
-            elif full_name.endswith('weight') and isinstance(m, blacklist):
-                no_decay.add(full_name)
+            if p.ndim <= 1 or isinstance(m, blacklist):
+                no_decay.append((full_name, p))
             else:
-                decay.add(full_name)
-
-            param_dict[full_name] = p
+                decay.append((full_name, p))
 
-    inter_params = decay & no_decay
-    union_params = decay | no_decay
-    assert(len(inter_params) == 0), "Overlapping decay and no decay"
-    assert(len(param_dict.keys() - union_params) == 0), "Missing decay parameters"
+    # sanity checks are dropped when running with python -O
+    if __debug__:
+        decay_names = {pn for pn, _ in decay}
+        no_decay_names = {pn for pn, _ in no_decay}
+        param_dict = {pn: p for pn, p in model.named_parameters()}
+        assert(len(decay_names & no_decay_names) == 0), "Overlapping decay and no decay"
+        assert(len(param_dict.keys() - (decay_names | no_decay_names)) == 0), "Missing decay parameters"
 
-    decay_params = [param_dict[pn] for pn in sorted(list(decay))]
-    no_decay_params = [param_dict[pn] for pn in sorted(list(no_decay))]
+    decay_params = [p for _, p in decay]
+    no_decay_params = [p for _, p in no_decay]
 
+    # groups only hold overrides, the optimizer
+    # fills in the rest from the opt_params defaults
     param_groups = [
-        {"params": decay_params, **opt_params},
-        {"params": no_decay_params, **opt_params}
+        {"params": decay_params},
+        {"params": no_decay_params, "weight_decay": 0.0}
     ]
-    param_groups[1]['weight_decay'] = 0 # overwrite default to 0 for no_decay group
 
     return optim.__dict__[opt_name](param_groups, **opt_params)
 
+def fast_collate(batch):
+    """
+    Collates a list of dataset samples into a batch dict. Images
+    stay uint8 so that host to device copies are 4x smaller; they
+    get normalized on the device by DataPrefetcher.
+    """
+    collated = {}
+    for k in batch[0].keys():
+        values = [sample[k] for sample in batch]
+        if isinstance(values[0], torch.Tensor):
+            collated[k] = torch.stack(values, dim=0)
+        else:
+            collated[k] = values
+
+    return collated
+
 def train(
     train_loader,
     model,
@@ -302,41 +390,70 @@ def train(
 
     meters = metrics.ComposeMetrics(metric_dict, class_names)
 
+    # gradients are accumulated over accum_steps batches,
+    # leftover batches at the end form a smaller accumulation
+    accum_steps = config['TRAIN'].get('accum_steps', 1)
+    n_batches = len(train_loader)
+    full_batches = n_batches - n_batches % accum_steps
+    last_batch = n_batches - 1
+
+    # metrics force a device sync, 0 means last batch only
+    metric_freq = config['TRAIN'].get('metric_freq', 0)
+
     # switch to train mode
     model.train()
+    optimizer.zero_grad(set_to_none=True)
+
+    # batches arrive normalized and already on the device
+    prefetcher = DataPrefetcher(train_loader, config['device'], config['MODEL']['norms'])
+
+    # target keys are the same for every batch
+    non_target_keys = frozenset(['image', 'fname'])
+    target_keys = None
 
     end = time.time()
-    for i, batch in enumerate(train_loader):
+    batch = prefetcher.next()
+    i = 0
+    while batch is not None:
         # measure data loading time
         data_time.update(time.time() - end)
 
-        images = batch['image']
-        target = {k: v for k,v in batch.items() if k not in ['image', 'fname']}
+        if target_keys is None:
+            target_keys = [k for k in batch.keys() if k not in non_target_keys]
 
-        images = images.to(config['device'], non_blocking=True)
-        target = {k: tensor.to(config['device'], non_blocking=True)
-                  for k,tensor in target.items()}
+        images = batch['image']
+        target = {k: batch[k] for k in target_keys}
 
-        # zero grad before running
-        optimizer.zero_grad()
+        images = images.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        if scaler is not None:
-            with autocast():
+        if config['TRAIN']['amp']:
+            with autocast('cuda', dtype=config['amp_dtype']):
                 output = model(images)
                 loss, aux_loss = criterion(output, target)  # output and target are both dicts
-
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
         else:
             output = model(images)
             loss, aux_loss = criterion(output, target)
+
+        # average the loss over accumulated batches
+        loss = loss / (accum_steps if i < full_batches else n_batches - full_batches)
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
             loss.backward()
-            optimizer.step()
 
-        # update the LR
-        scheduler.step()
+        if (i + 1) % accum_steps == 0 or i == last_batch:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+
+            # zero grad for the next accumulation
+            optimizer.zero_grad(set_to_none=True)
+
+            # update the LR
+            scheduler.step()
 
         # record losses
         if loss_meters is None:
@@ -351,8 +468,9 @@ def train(
                 loss_meters[k].update(v)
 
         # calculate human-readable per epoch metrics
-        with torch.no_grad():
-            meters.evaluate(output, target)
+        if (metric_freq and i % metric_freq == 0) or i == last_batch:
+            with torch.no_grad():
+                meters.evaluate({k: v.detach() for k,v in output.items()}, target)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -361,6 +479,9 @@ def train(
         if i % config['TRAIN']['print_freq'] == 0:
             progress.display(i)
 
+        i += 1
+        batch = prefetcher.next()
+
     # end of epoch print evaluation metrics
     print('\n')
     print(f'Epoch {epoch} training metrics:')
@@ -398,15 +519,14 @@ def validate(
     engine_name = config['FINETUNE']['engine']
     engine = engines.__dict__[engine_name](model, **config['FINETUNE']['engine_params'])
 
-    for i, batch in enumerate(eval_loader):
+    prefetcher = DataPrefetcher(eval_loader, config['device'], config['MODEL']['norms'])
+    batch = prefetcher.next()
+    i = 0
+    while batch is not None:
         end = time.time()
         images = batch['image']
         target = {k: v for k,v in batch.items() if k not in ['image', 'fname']}
 
-        images = images.to(config['device'], non_blocking=True)
-        target = {k: tensor.to(config['device'], non_blocking=True)
-                  for k,tensor in target.items()}
-
         # compute panoptic segmentations
         # from prediction and ground truth
         output = engine.infer(images)
@@ -441,12 +561,80 @@ def validate(
         if i % config['TRAIN']['print_freq'] == 0:
             progress.display(i)
 
+        i += 1
+        batch = prefetcher.next()
+
     # end of epoch print evaluation metrics
     print('\n')
     print(f'Validation results:')
     meters.display()
     print('\n')
 
+class DataPrefetcher:
+    """
+    Wraps a DataLoader and copies the next batch to the device
+    on a side CUDA stream while the current batch is being used.
+    Falls back to plain synchronous copies on CPU.
+
+    If norms are given, uint8 images are normalized right after
+    the copy, equivalent to A.Normalize with max_pixel_value=255.
+    """
+    def __init__(self, loader, device, norms=None):
+        self.loader_iter = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+        # built once and reused for every batch
+        self.mean = None
+        self.std = None
+        if norms is not None:
+            self.mean = torch.tensor(norms['mean'], device=device).view(1, -1, 1, 1) * 255
+            self.std = torch.tensor(norms['std'], device=device).view(1, -1, 1, 1) * 255
+
+        # mean and std are computed on the current stream,
+        # they must be ready before the side stream uses them
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+
+        self.preload()
+
+    def _to_device(self, batch):
+        batch = {
+            k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+            for k,v in batch.items()
+        }
+        if self.mean is not None:
+            batch['image'] = batch['image'].float().sub_(self.mean).div_(self.std)
+
+        return batch
+
+    def preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is None:
+            self.batch = self._to_device(batch)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.batch = self._to_device(batch)
+
+    def next(self):
+        batch = self.batch
+        if self.stream is not None and batch is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            # tensors were allocated on the side stream, make sure
+            # their memory isn't reused while still needed here
+            for v in batch.values():
+                if isinstance(v, torch.Tensor):
+                    v.record_stream(current_stream)
+
+        self.preload()
+        return batch
+
 class ProgressAverageMeter(metrics.AverageMeter):
     """Computes and stores the average and current value"""
     def __init__(self, name, fmt=':f'):
@@ -459,15 +647,24 @@ class ProgressAverageMeter(metrics.AverageMeter):
         return fmtstr.format(**self.__dict__)
 
 class ProgressEMAMeter(metrics.EMAMeter):
-    """Computes and stores the exponential moving average and current value"""
+    """
+    Computes and stores the exponential moving average and current value.
+    Tensor values stay on their device and are only synced when printed.
+    """
     def __init__(self, name, fmt=':f', momentum=0.98):
         self.name = name
         self.fmt = fmt
         super().__init__(momentum)
 
+    def update(self, val):
+        if isinstance(val, torch.Tensor):
+            val = val.detach()
+
+        super().update(val)
+
     def __str__(self):
         fmtstr = '{name} {avg' + self.fmt + '}'
-        return fmtstr.format(**self.__dict__)
+        return fmtstr.format(name=self.name, avg=float(self.avg))
 
 class ProgressMeter:
     def __init__(self, num_batches, meters, prefix=""):
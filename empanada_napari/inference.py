@@ -1,4 +1,4 @@
-import os, platform
+import os, platform, math
 import zarr
 import numpy as np
 import torch
@@ -11,6 +11,7 @@ from empanada.data import VolumeDataset
 from empanada.data.utils import resize_by_factor
 
 from empanada.inference import filters
+from empanada.inference.postprocess import factor_pad
 from empanada.inference.engines import (
     PanopticDeepLabRenderEngine, PanopticDeepLabRenderEngine3d
 )
@@ -277,9 +278,28 @@ class Engine2d:
 
         return pan_seg
 
-    def infer(self, image):
+    def _match_size(self, pan_seg, size):
+        # pyramid levels with floored shapes can render
+        # a few pixels short of the full resolution size
+        padh = size[0] - pan_seg.shape[0]
+        padw = size[1] - pan_seg.shape[1]
+        if padh > 0 or padw > 0:
+            pan_seg = np.pad(pan_seg, ((0, max(padh, 0)), (0, max(padw, 0))), mode='edge')
+
+        return pan_seg
+
+    def infer(self, image, level_scale=1, size=None):
+        # level_scale is the factor by which image was already
+        # downsampled (e.g. a multiscale level), the segmentation
+        # is rendered at size, the full resolution (h, w) shape.
+        # Only supported without tiling.
         # engine handles upsampling and padding
+        if size is None:
+            assert level_scale == 1, "Full resolution size is required for downsampled images!"
+            size = image.shape
+
         if self.tile_size > 0 and any([s > self.tile_size for s in image.shape]):
+            assert level_scale == 1, "Tiled inference requires a full resolution image!"
             print('Tiling image for inference...')
             tiler = Tiler(
                 image.shape, tile_size=self.tile_size, 
@@ -316,12 +336,50 @@ class Engine2d:
             pan_seg = rle.rle_seg_to_pan_seg(rle_seg, image.shape)
             return pan_seg
         else:
-            size = image.shape
             # resize image to correct scale
-            image = resize_by_factor(image, self.inference_scale)
+            image = resize_by_factor(image, self.inference_scale // level_scale)
             image = self.preprocessor(image)['image'].unsqueeze(0)
             pan_seg = self.engine(image, size, upsampling=self.inference_scale)
-            return self.force_connected(pan_seg.squeeze().cpu().numpy().astype(np.int32))
+            pan_seg = self._match_size(pan_seg.squeeze().cpu().numpy().astype(np.int32), size)
+            return self.force_connected(pan_seg)
+
+    def infer_batch(self, images, level_scale=1, size=None):
+        r"""Segments a stack of same-sized 2D images (N, H, W) with a
+        single forward pass through the model. Returns a stack of
+        segmentations."""
+        if size is None:
+            assert level_scale == 1, "Full resolution size is required for downsampled images!"
+            size = images.shape[1:]
+
+        h, w = size
+
+        # tiled inference runs one image at a time
+        if self.tile_size > 0 and any([s > self.tile_size for s in images.shape[1:]]):
+            return np.stack([self.infer(image, level_scale, size) for image in images], axis=0)
+
+        batch = torch.cat([
+            self.preprocessor(resize_by_factor(image, self.inference_scale // level_scale))['image'].unsqueeze(0)
+            for image in images
+        ], dim=0)
+
+        # same steps as the engine's __call__ but
+        # with postprocessing done per image
+        upsampling = self.inference_scale
+        batch = factor_pad(batch, self.padding_factor)
+        batch = self.engine.to_model_device(batch)
+        model_out = self.engine.infer(batch, int(2 + math.log(upsampling, 2)))
+
+        pan_segs = []
+        for i in range(len(batch)):
+            instance_cells = self.engine.get_instance_cells(
+                model_out['ctr_hmp'][i:i+1], model_out['offsets'][i:i+1], upsampling
+            )
+            pan_seg = self.engine.postprocess(model_out['sem'][i:i+1], instance_cells)
+            pan_seg = pan_seg[..., :h, :w]
+            pan_seg = self._match_size(pan_seg.squeeze().cpu().numpy().astype(np.int32), size)
+            pan_segs.append(self.force_connected(pan_seg))
+
+        return np.stack(pan_segs, axis=0)
 
 class Engine3d:
     r"""Engine for 3D ortho-plane and stack inference"""